@@ -31,13 +31,20 @@ Security Measures:
 """
 
 
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, g, jsonify, stream_template
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import psycopg2
+import psycopg2.extensions
+import threading
+from functools import wraps
 from datetime import datetime
 from flask import flash
-from crypto_utils import MedicalCrypto
+from crypto_utils import MedicalCrypto, detect_crypto_acceleration
 import os
+import base64
+import json
+import redis
 from dotenv import load_dotenv
 import logging
 logging.basicConfig(level=logging.ERROR)
@@ -63,25 +70,292 @@ if not all([DB_HOST, DB_NAME, DB_USER, DB_PASSWORD]):
 def index():
     return render_template("index.html")
 
-# Database connection to PostgreSQL
-def get_db_connection():
+# Health check reporting detected crypto acceleration
+@app.route('/healthz')
+def healthz():
+    return jsonify(status='ok', crypto=detect_crypto_acceleration())
+
+# Server-side prepared statements, created once per pooled connection
+PREPARED_STATEMENTS = {
+    'get_patient_stmt': 'SELECT id, dob, gender, encrypted_data FROM patients WHERE id = $1',
+    # Inserting the patient and appending its audit entry in one round-trip
+    'add_patient_stmt': 'WITH new_patient AS ('
+                        'INSERT INTO patients (dob, gender, encrypted_data) VALUES ($1, $2, $3) RETURNING id'
+                        ') SELECT append_audit_log($4, $5, $6, $7) FROM new_patient',
+    'edit_patient_stmt': 'UPDATE patients SET dob=$1, gender=$2, encrypted_data=$3 WHERE id=$4',
+    'edit_treatment_stmt': 'UPDATE patients SET encrypted_data=$1 WHERE id=$2',
+    'delete_patient_stmt': 'DELETE FROM patients WHERE id = $1',
+    'append_audit_log_stmt': 'SELECT append_audit_log($1, $2, $3, $4)',
+}
+
+# Connection class remembering whether PREPARED_STATEMENTS ran on this session
+class PreparedConnection(psycopg2.extensions.connection):
+    prepared = False
+
+# Sending every PREPARE in a single round trip. Autocommit avoids the
+# separate BEGIN and COMMIT; prepared statements outlive transactions anyway.
+def prepare_statements(conn):
+    conn.autocommit = True
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+        with conn.cursor() as cur:
+            cur.execute('; '.join(
+                f'PREPARE {name} AS {statement}' for name, statement in PREPARED_STATEMENTS.items()
+            ))
+    finally:
+        # A dead connection can't be reset; leaving it so the original error is reported
+        if not conn.closed:
+            conn.autocommit = False
+    conn.prepared = True
+
+# Connection pool shared by all requests, created on first use so the app
+# can start before the database is reachable. minconn equals maxconn because
+# psycopg2 closes returned connections once minconn idle ones are pooled;
+# this way every session (and its prepared statements) is kept.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20'))
+POOL = None
+_pool_lock = threading.Lock()
+
+# Errors meaning a pooled session is gone, e.g. after PostgreSQL restarted
+DB_DISCONNECT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def get_pool():
+    global POOL
+    if POOL is None:
+        with _pool_lock:
+            if POOL is None:
+                POOL = ThreadedConnectionPool(
+                    minconn=DB_POOL_SIZE,
+                    maxconn=DB_POOL_SIZE,
+                    host=DB_HOST,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    connection_factory=PreparedConnection,
+                    cursor_factory=RealDictCursor
+                )
+    return POOL
+
+# Database connection to PostgreSQL, borrowed from the pool for this request.
+# With check_alive each borrowed session is pinged first; dead ones are closed
+# until a live or newly opened one is found.
+def get_db_connection(check_alive=False):
+    if 'conn' in g:
+        return g.conn
+    for _ in range(DB_POOL_SIZE + 1):
+        try:
+            conn = get_pool().getconn()
+        except psycopg2.Error as e:
+            logging.error(f"Database connection error: {e}")
+            return None
+        try:
+            if check_alive:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            if not conn.prepared:
+                prepare_statements(conn)
+        except DB_DISCONNECT_ERRORS as e:
+            logging.error(f"Discarding dead database connection: {e}")
+            POOL.putconn(conn, close=True)
+            continue
+        except psycopg2.Error as e:
+            logging.error(f"Database connection error: {e}")
+            POOL.putconn(conn)
+            return None
+        g.conn = conn
         return conn
-    except psycopg2.Error as e:
-        logging.error(f"Database connection error: {e}")
-        return None
+    return None
+
+# Closing the request's connection instead of returning it to the pool
+def discard_db_connection():
+    conn = g.pop('conn', None)
+    if conn is not None:
+        POOL.putconn(conn, close=True)
+
+# Running a view again, once, on a live connection when its pooled session
+# turns out to be dead
+def retry_on_db_disconnect(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except DB_DISCONNECT_ERRORS as e:
+            logging.error(f"Database connection lost, retrying: {e}")
+            discard_db_connection()
+            if get_db_connection(check_alive=True) is None:
+                flash('Database connection failed')
+                return redirect(url_for('index'))
+            return view(*args, **kwargs)
+    return wrapper
+
+# Returning the request's connection to the pool; dead ones are closed
+@app.teardown_request
+def release_db_connection(exception=None):
+    conn = g.pop('conn', None)
+    if conn is not None:
+        POOL.putconn(conn, close=bool(conn.closed) or isinstance(exception, DB_DISCONNECT_ERRORS))
+
+
+# Optional Redis cache for the patient distribution charts
+REDIS_URL = os.getenv('REDIS_URL')
+# Short timeouts so an unresponsive Redis falls back to the database instead of
+# stalling requests for the OS TCP timeout
+REDIS_TIMEOUT = float(os.getenv('REDIS_TIMEOUT', '0.1'))
+cache = redis.Redis.from_url(
+    REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT
+) if REDIS_URL else None
+
+# Seconds a cached distribution stays valid (ages shift even without writes)
+DISTRIBUTION_TTL = 300
+
+# Restricting a view to one role. The role comes from the form or query string
+# (default_role when absent) and is stored on flask.g for the view.
+# Other roles are sent back to their patient list, unknown callers to the homepage.
+def require_role(required_role, default_role=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            role = request.form.get('role') or request.args.get('role', default_role)
+            if role != required_role:
+                if role is None:
+                    return redirect(url_for('index'))
+                return redirect(url_for('patients', role=role))
+            g.role = role
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Rows per page for paginated lists
+PAGE_SIZE = 50
+
+# Keyset pagination over a table's id column.
+# ?cursor=<id> moves forward past that id, ?before=<id> moves back before it.
+def fetch_page(cur, table, columns, descending=False):
+    cursor = request.args.get('cursor', type=int)
+    before = request.args.get('before', type=int)
+    forward_op, backward_op = ('<', '>') if descending else ('>', '<')
+    forward_order, backward_order = ('DESC', 'ASC') if descending else ('ASC', 'DESC')
+
+    if before is not None:
+        cur.execute(
+            f'SELECT {columns} FROM {table} WHERE id {backward_op} %s ORDER BY id {backward_order} LIMIT %s',
+            (before, PAGE_SIZE + 1)
+        )
+        rows = cur.fetchall()
+        has_prev = len(rows) > PAGE_SIZE
+        rows = rows[:PAGE_SIZE][::-1]
+        has_next = True
+    else:
+        if cursor is not None:
+            cur.execute(
+                f'SELECT {columns} FROM {table} WHERE id {forward_op} %s ORDER BY id {forward_order} LIMIT %s',
+                (cursor, PAGE_SIZE + 1)
+            )
+        else:
+            cur.execute(
+                f'SELECT {columns} FROM {table} ORDER BY id {forward_order} LIMIT %s',
+                (PAGE_SIZE + 1,)
+            )
+        rows = cur.fetchall()
+        has_next = len(rows) > PAGE_SIZE
+        rows = rows[:PAGE_SIZE]
+        has_prev = cursor is not None
+
+    next_cursor = rows[-1]['id'] if rows and has_next else None
+    prev_cursor = rows[0]['id'] if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
+
+# Gender and age distribution of all patients, aggregated in PostgreSQL
+def compute_patient_distribution(cur):
+    # -------------------------------
+    # Calculating Gender Distribution
+    # -------------------------------
+    cur.execute('SELECT gender, COUNT(*) AS count FROM patients GROUP BY gender;')
+    gender_counts = {row['gender']: row['count'] for row in cur.fetchall()}
 
+    # ----------------------------
+    # Calculating Age Distribution
+    # ----------------------------
+    # width_bucket returns 0 for <20, 1 for 20-39, 2 for 40-59 and 3 for 60+
+    cur.execute(
+        'SELECT width_bucket(EXTRACT(YEAR FROM age(dob))::int, ARRAY[20, 40, 60]) AS bucket, '
+        'COUNT(*) AS count FROM patients GROUP BY bucket;'
+    )
+    bucket_counts = {row['bucket']: row['count'] for row in cur.fetchall()}
+
+    male_count = gender_counts.pop('Male', 0)
+    female_count = gender_counts.pop('Female', 0)
+    other_count = sum(gender_counts.values())
+    patient_count = male_count + female_count + other_count
+    total = max(patient_count, 1) 
+
+    gender_data = {
+        "male": male_count,
+        "female": female_count,
+        "other": other_count,
+        "male_percent": (male_count / total) * 100,
+        "female_percent": (female_count / total) * 100,
+        "other_percent": (other_count / total) * 100,
+    }
+
+    age_bins = {
+        label: bucket_counts.get(bucket, 0)
+        for bucket, label in enumerate(["<20", "20-39", "40-59", "60+"])
+    }
+
+    return {
+        "patient_count": patient_count,
+        "gender_data": gender_data,
+        "age_bins": age_bins,
+    }
+
+# Distribution cached in Redis under the current patients table version;
+# falls back to computing it when Redis is not configured or unreachable
+def get_patient_distribution(cur):
+    if cache is None:
+        return compute_patient_distribution(cur)
+
+    try:
+        version = cache.get('patients:version') or b'0'
+        key = f"patients:dist:{version.decode()}"
+        cached = cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        distribution = compute_patient_distribution(cur)
+        cache.setex(key, DISTRIBUTION_TTL, json.dumps(distribution))
+        return distribution
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return compute_patient_distribution(cur)
+
+# Bumping the table version so cached distributions are no longer used
+def invalidate_patient_distribution():
+    if cache is None:
+        return
+    try:
+        cache.incr('patients:version')
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+# Decrypting a patients row into the fields the templates use; dob and gender
+# come from their plaintext columns (kept for the SQL demographics), the rest
+# from encrypted_data. Returns None if the record cannot be decrypted, so callers
+# never write empty fields back over it
+def decrypt_patient_row(row):
+    try:
+        patient = crypto.decrypt_patient_data(row['encrypted_data'], strict=True)
+    except Exception as e:
+        print(f"Could not decrypt patient {row['id']}: {e}")
+        return None
+    patient.update(id=row['id'], dob=row['dob'], gender=row['gender'])
+    return patient
 
 # -------------------------
 #  Patients List
 # -------------------------
 @app.route('/patients')
+@retry_on_db_disconnect
 def patients():
     role = request.args.get('role', 'Doctor')  # Default = Doctor if none provided
     conn = get_db_connection()
@@ -90,70 +364,39 @@ def patients():
         flash('Database connection failed')
         return redirect(url_for('index'))
     
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute('SELECT * FROM patients ORDER BY id;')
-    patients = cur.fetchall()
+    cur = conn.cursor()
+    rows, next_cursor, prev_cursor = fetch_page(cur, 'patients', 'id, dob, gender, encrypted_data')
+    patients = []
+    for row in rows:
+        patient = decrypt_patient_row(row)
+        if patient is None:
+            patient = {'id': row['id'], 'dob': row['dob'], 'gender': row['gender'],
+                       'name': 'Unable to decrypt record', 'diagnosis': '', 'treatment': '',
+                       'decrypt_failed': True}
+        patients.append(patient)
+
+    distribution = get_patient_distribution(cur)
     cur.close()
-    conn.close()
-    
-
-    # -------------------------------
-    # Calculating Gender Distribution
-    # -------------------------------
-    male_count = len([p for p in patients if p['gender'] == "Male"])
-    female_count = len([p for p in patients if p['gender'] == "Female"])
-    other_count = len([p for p in patients if p['gender'] not in ["Male", "Female"]])
-    total = max(len(patients), 1) 
-
-    gender_data = {
-        "male": male_count,
-        "female": female_count,
-        "other": other_count,
-        "male_percent": (male_count / total) * 100,
-        "female_percent": (female_count / total) * 100,
-        "other_percent": (other_count / total) * 100,
-    }
-
-    # ----------------------------
-    # Calculating Age Distribution
-    # ----------------------------
-    from datetime import date
-    today = date.today()
-    age_bins = {"<20": 0, "20-39": 0, "40-59": 0, "60+": 0}
-
-    for p in patients:
-        try:
-            dob = p['dob']
-            if isinstance(dob, str):
-                dob = datetime.strptime(dob, "%Y-%m-%d").date()
-            age = (today - dob).days // 365
-            if age < 20:
-                age_bins["<20"] += 1
-            elif age < 40:
-                age_bins["20-39"] += 1
-            elif age < 60:
-                age_bins["40-59"] += 1
-            else:
-                age_bins["60+"] += 1
-        except:
-            pass  
 
     return render_template(
         'patients.html',
         patients=patients,
+        patient_count=distribution['patient_count'],
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
         role=role,
-        gender_data=gender_data,
-        age_bins=age_bins
+        gender_data=distribution['gender_data'],
+        age_bins=distribution['age_bins']
     )
 
 # -------------------------
 #  Add Patient
 # -------------------------
 @app.route('/add_patient', methods=['GET', 'POST'])
+@require_role('Doctor', default_role='Doctor')
+@retry_on_db_disconnect
 def add_patient():
-    role = request.form.get('role') or request.args.get('role', 'Doctor')
-    if role != 'Doctor':
-        return redirect(url_for('patients', role=role))
+    role = g.role
 
     if request.method == 'POST':
         patient_data = {
@@ -172,40 +415,25 @@ def add_patient():
             flash('Database connection failed')
             return redirect(url_for('index'))
     
-        cur = conn.cursor(cursor_factory=RealDictCursor)  # Changed to RealDictCursor
+        cur = conn.cursor()
 
-        # Inserting new patient
+        # Inserting new patient and logging the action (hash chain is extended inside the database)
         encrypted_data = crypto.encrypt_patient_data(patient_data)
         
         cur.execute(
-            'INSERT INTO patients (name, dob, gender, address, phone, diagnosis, treatment, encrypted_data) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
-            (patient_data['name'], patient_data['dob'], patient_data['gender'], 
-             patient_data['address'], patient_data['phone'], patient_data['diagnosis'], 
-             patient_data['treatment'], encrypted_data)
-        )
-
-        # Logging the action  
-        cur.execute('SELECT hash FROM audit_logs ORDER BY timestamp DESC LIMIT 1')
-        last_record = cur.fetchone()
-        prev_hash = last_record['hash'] if last_record else '0' * 64  
-
-        timestamp = datetime.now()
-        new_hash = crypto.create_log_hash(prev_hash, role, 'Add Patient', 
-            f'Added {patient_data["name"]}', timestamp)  
-
-        cur.execute(
-            'INSERT INTO audit_logs (role, action, details, timestamp, prev_hash, hash) VALUES (%s, %s, %s, %s, %s, %s)',
-            (role, 'Add Patient', 
+            'EXECUTE add_patient_stmt(%s, %s, %s, %s, %s, %s, %s)',
+            (patient_data['dob'], patient_data['gender'], encrypted_data,
+            role, 'Add Patient', 
             f'Added new patient: Name={patient_data["name"]}, DOB={patient_data["dob"]}, ' +
             f'Gender={patient_data["gender"]}, Address={patient_data["address"]}, ' +
             f'Phone={patient_data["phone"]}, Diagnosis={patient_data["diagnosis"]}, ' +
             f'Treatment={patient_data["treatment"]}',
-            timestamp, prev_hash, new_hash)
+            datetime.now())
         )
 
         conn.commit()
+        invalidate_patient_distribution()
         cur.close()
-        conn.close()
         return redirect(url_for('patients', role=role))
 
     return render_template('add_patient.html', role=role)
@@ -214,19 +442,18 @@ def add_patient():
 #  Edit Patient
 # -------------------------
 @app.route('/edit_patient/<int:id>', methods=['GET', 'POST'])
+@require_role('Doctor', default_role='Doctor')
+@retry_on_db_disconnect
 def edit_patient(id):
-    role = request.form.get('role') or request.args.get('role', 'Doctor')
-    
-    if role != 'Doctor':
-        return redirect(url_for('patients', role=role))
-        
+    role = g.role
+
     conn = get_db_connection()
 
     if conn is None:
         flash('Database connection failed')
         return redirect(url_for('index'))
     
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor()
 
     if request.method == 'POST':
         patient_data = {
@@ -242,125 +469,108 @@ def edit_patient(id):
         encrypted_data = crypto.encrypt_patient_data(patient_data)
         
         cur.execute(
-            'UPDATE patients SET name=%s, dob=%s, gender=%s, address=%s, phone=%s, diagnosis=%s, treatment=%s, encrypted_data=%s WHERE id=%s',
-            (patient_data['name'], patient_data['dob'], request.form['gender'], 
-             patient_data['address'], patient_data['phone'], 
-             patient_data['diagnosis'], patient_data['treatment'], 
-             encrypted_data, id)
+            'EXECUTE edit_patient_stmt(%s, %s, %s, %s)',
+            (patient_data['dob'], patient_data['gender'], encrypted_data, id)
         )
 
         # Logging the update
-        cur.execute('SELECT hash FROM audit_logs ORDER BY timestamp DESC LIMIT 1')
-        last_record = cur.fetchone()
-        prev_hash = last_record['hash'] if last_record else '0' * 64  
-        
-        timestamp = datetime.now()
-        new_hash = crypto.create_log_hash(prev_hash, role, 'Edit Patient', 
-            f'Edited patient: {patient_data["name"]}', timestamp)  
-        
         cur.execute(
-            'INSERT INTO audit_logs (role, action, details, timestamp, prev_hash, hash) VALUES (%s, %s, %s, %s, %s, %s)',
+            'EXECUTE append_audit_log_stmt(%s, %s, %s, %s)',
             (role, 'Edit Patient', 
             f'Updated patient {patient_data["name"]}: DOB={patient_data["dob"]}, ' +
             f'Gender={patient_data["gender"]}, Address={patient_data["address"]}, ' +
             f'Phone={patient_data["phone"]}, Diagnosis={patient_data["diagnosis"]}, ' +
             f'Treatment={patient_data["treatment"]}',
-            timestamp, prev_hash, new_hash)
+            datetime.now())
         )
 
         conn.commit()
+        invalidate_patient_distribution()
         cur.close()
-        conn.close()
         return redirect(url_for('patients', role=role))
 
-    cur.execute('SELECT * FROM patients WHERE id=%s', (id,))
-    patient = cur.fetchone()
+    cur.execute('EXECUTE get_patient_stmt(%s)', (id,))
+    row = cur.fetchone()
     cur.close()
-    conn.close()
+    patient = decrypt_patient_row(row) if row else None
+    if row and patient is None:
+        flash('Unable to decrypt patient record')
+        return redirect(url_for('patients', role=role))
     return render_template('edit_patient.html', patient=patient, role=role)
 
 # -------------------------
 #  Edit Treatment (Nurse)
 # -------------------------
 @app.route('/edit_treatment/<int:id>', methods=['GET', 'POST'])
+@require_role('Nurse', default_role='Nurse')
+@retry_on_db_disconnect
 def edit_treatment(id):
-    role = request.form.get('role') or request.args.get('role', 'Nurse')
-    
-    if role != 'Nurse':
-        return redirect(url_for('patients', role=role))
-        
+    role = g.role
+
     conn = get_db_connection()
 
     if conn is None:
         flash('Database connection failed')
         return redirect(url_for('index'))
     
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor()
 
     if request.method == 'POST':
         treatment = request.form['treatment']
 
         # Getting all current patient data
-        cur.execute('SELECT * FROM patients WHERE id=%s', (id,))
-        current = cur.fetchone()
+        cur.execute('EXECUTE get_patient_stmt(%s)', (id,))
+        row = cur.fetchone()
+        current = decrypt_patient_row(row) if row else None
+
+        # Re-encrypting a record that failed to decrypt would overwrite it with empty fields
+        if current is None:
+            cur.close()
+            flash('Unable to decrypt patient record; treatment was not updated')
+            return redirect(url_for('patients', role=role))
 
         # Creating patient data dictionary for encryption
-        patient_data = {
-            'name': current['name'],
-            'dob': current['dob'],
-            'address': current['address'],
-            'phone': current['phone'],
-            'diagnosis': current['diagnosis'],
-            'treatment': treatment,  
-            'gender': current['gender']  
-        }
+        patient_data = dict(current, treatment=treatment)
 
         # Encrypting all patient data
         encrypted_data = crypto.encrypt_patient_data(patient_data)
         
-        
         cur.execute(
-            'UPDATE patients SET treatment=%s, encrypted_data=%s WHERE id=%s',
-            (treatment, encrypted_data, id)
+            'EXECUTE edit_treatment_stmt(%s, %s)',
+            (encrypted_data, id)
         )
         
         # Logging the update
-        cur.execute('SELECT hash FROM audit_logs ORDER BY timestamp DESC LIMIT 1')
-        last_record = cur.fetchone()
-        prev_hash = last_record['hash'] if last_record else '0' * 64  # Changed to use dictionary key
-        
-        timestamp = datetime.now()
-        new_hash = crypto.create_log_hash(prev_hash, role, 'Update Treatment', 
-            f'Updated treatment for patient: {patient_data["name"]} (ID: {id})', timestamp)
-
         cur.execute(
-            'INSERT INTO audit_logs (role, action, details, timestamp, prev_hash, hash) VALUES (%s, %s, %s, %s, %s, %s)',
+            'EXECUTE append_audit_log_stmt(%s, %s, %s, %s)',
             (role, 'Update Treatment', 
             f'Updated treatment for {patient_data["name"]}: Previous="{current["treatment"]}", ' +
             f'New="{treatment}"', 
-            timestamp, prev_hash, new_hash)
+            datetime.now())
         )
 
         conn.commit()
         cur.close()
-        conn.close()
         return redirect(url_for('patients', role=role))
 
-    cur.execute('SELECT * FROM patients WHERE id=%s', (id,))
-    patient = cur.fetchone()
+    cur.execute('EXECUTE get_patient_stmt(%s)', (id,))
+    row = cur.fetchone()
     cur.close()
-    conn.close()
+    patient = decrypt_patient_row(row) if row else None
+    if row and patient is None:
+        flash('Unable to decrypt patient record')
+        return redirect(url_for('patients', role=role))
     return render_template('treatment_updates.html', patient=patient, role=role)
 
 # -------------------------
 #  Delete Patient
 # -------------------------
 @app.route('/delete_patient/<int:id>', methods=['POST'])
+@require_role('Doctor', default_role='Doctor')
+@retry_on_db_disconnect
 def delete_patient(id):
-    role = request.form.get('role') or request.args.get('role', 'Doctor')
-    if role != 'Doctor':
-        return redirect(url_for('patients', role=role))
-    
+    role = g.role
+
     conn = get_db_connection()
 
     if conn is None:
@@ -368,121 +578,93 @@ def delete_patient(id):
         return redirect(url_for('index'))
 
     # Getting patient name before deleting
-    cur = conn.cursor(cursor_factory=RealDictCursor)  # Changed to RealDictCursor
-    cur.execute('SELECT name FROM patients WHERE id=%s', (id,))
-    patient = cur.fetchone()
-
-    # Creating hash chain for audit log
-    cur.execute('SELECT hash FROM audit_logs ORDER BY timestamp DESC LIMIT 1')
-    last_record = cur.fetchone()
-    prev_hash = last_record['hash'] if last_record else '0' * 64  # Changed to use dictionary key
-    
-    timestamp = datetime.now()
-    new_hash = crypto.create_log_hash(prev_hash, role, 'Delete Patient', 
-        f'Deleted {patient["name"] if patient else "Unknown"}', timestamp)
-    
-    # Adding audit log entry
+    cur = conn.cursor()
+    cur.execute('EXECUTE get_patient_stmt(%s)', (id,))
+    row = cur.fetchone()
+    patient = decrypt_patient_row(row) if row else None
 
+    # Adding audit log entry to the hash chain
     cur.execute(
-        'INSERT INTO audit_logs (role, action, details, timestamp, prev_hash, hash) VALUES (%s, %s, %s, %s, %s, %s)',
-        (role, 'Delete Patient', f'Deleted patient: {patient["name"]}', timestamp, prev_hash, new_hash)
+        'EXECUTE append_audit_log_stmt(%s, %s, %s, %s)',
+        (role, 'Delete Patient', f'Deleted patient: {patient["name"] if patient else "Unknown"}', datetime.now())
     )
 
     # Deleting the patient
-    cur.execute('DELETE FROM patients WHERE id=%s', (id,))
+    cur.execute('EXECUTE delete_patient_stmt(%s)', (id,))
 
     conn.commit()
+    invalidate_patient_distribution()
     cur.close()
-    conn.close()
     return redirect(url_for('patients', role=role))
 
 # -------------------------
 #  Audit Logs (Admin)
 # -------------------------
 @app.route('/logs')
+@require_role('Admin')
+@retry_on_db_disconnect
 def logs():
-    role = request.args.get('role')
-    if role != 'Admin':
-        return redirect(url_for('index'))
-    
+    role = g.role
+
     try:
         conn = get_db_connection()
         if conn is None:
             flash('Database connection error')
             return redirect(url_for('index'))
-            
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM audit_logs ORDER BY timestamp DESC;')
-        logs = cur.fetchall()
-        
-        return render_template('logs.html', logs=logs, role=role)  # Added role here
+
+        # Newest first; ids follow chain order since append_audit_log serializes inserts
+        cur = conn.cursor()
+        logs, next_cursor, prev_cursor = fetch_page(cur, 'audit_logs', '*', descending=True)
+        cur.close()
         
+    except DB_DISCONNECT_ERRORS:
+        # Left to retry_on_db_disconnect
+        raise
     except psycopg2.Error as e:
         print(f"Database error: {e}")
         flash('Database error occurred')
         return redirect(url_for('index'))
-        
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
+
+    # The page is already loaded, so streaming the HTML cannot fail on a database error
+    return stream_template('logs.html', logs=logs, role=role,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 # ----------------------------
 #  View Encrypted Data (Admin)
 # ----------------------------
 @app.route('/view_encrypted/<int:id>')
+@require_role('Admin')
+@retry_on_db_disconnect
 def view_encrypted(id):
-    role = request.args.get('role')
-    if role != 'Admin':
-        return redirect(url_for('index'))
-        
+    role = g.role
+
     conn = get_db_connection()
     if conn is None:
         flash('Database connection failed')
         return redirect(url_for('index'))
     
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor()
     
-    cur.execute('SELECT * FROM patients WHERE id=%s', (id,))
+    cur.execute('EXECUTE get_patient_stmt(%s)', (id,))
     patient = cur.fetchone()
     
-    # Handling None values and creating patient_data dictionary
-    if patient and not patient['encrypted_data']:
-        patient_data = {
-            'name': patient['name'] or '',
-            'dob': patient['dob'] or '',
-            'gender': patient['gender'] or '',
-            'address': patient['address'] or '',
-            'phone': patient['phone'] or '',
-            'diagnosis': patient['diagnosis'] or '',
-            'treatment': patient['treatment'] or ''
-        }
-        encrypted_data = crypto.encrypt_patient_data(patient_data)
-        cur.execute(
-            'UPDATE patients SET encrypted_data=%s WHERE id=%s',
-            (encrypted_data, id)
-        )
-        conn.commit()
-        patient['encrypted_data'] = encrypted_data
-    
     # Converting memoryview to string and decrypt data
     decrypted_data = None
     if patient and patient['encrypted_data']:
         try:
             # Converting memoryview to bytes
             encrypted_bytes = bytes(patient['encrypted_data'])
-            # Store base64 string for display
-            patient['encrypted_string'] = encrypted_bytes.decode('utf-8')
+            # Base64 encoding only for display
+            patient['encrypted_string'] = base64.b64encode(encrypted_bytes).decode('ascii')
             # Decrypting the data
             decrypted_data = crypto.decrypt_patient_data(encrypted_bytes)
+            patient['name'] = decrypted_data['name']
         except Exception as e:
             print(f"Error processing encrypted data: {e}")
             patient['encrypted_string'] = "Error processing encrypted data"
             flash('Error processing encrypted data')
     
     cur.close()
-    conn.close()
     
     return render_template('view_encrypted.html', 
                          patient=patient, 
@@ -4,21 +4,22 @@ CRYPTOGRAPHIC UTILITIES MODULE
 ==============================================================================
 
 Purpose: Provides enterprise-grade encryption and security functions for 
-         protecting sensitive medical data and maintaining audit integrity.
+         protecting sensitive medical data.
 
 Key Responsibilities:
 - AES-256-GCM encryption/decryption of patient records
 - Secure key derivation using PBKDF2 with SHA-256
 - Salt generation and management for enhanced security
-- Cryptographic hash chain creation for audit logs
+- Caching of the derived key (dek.bin) to skip PBKDF2 on restart
+- Startup probe for AES-NI / PCLMULQDQ hardware acceleration
 - Data integrity verification and validation
 
 Encryption Standards:
 - Algorithm: AES-256-GCM (Galois/Counter Mode)
 - Key Derivation: PBKDF2 with 100,000 iterations
 - IV Generation: Cryptographically secure random (96-bit)
+- Envelope Encryption: Per-record data key wrapped with the master key
 - Authentication: Built-in authenticated encryption
-- Hash Function: SHA-256 for audit log integrity
 
 Security Features:
 - Authenticated encryption prevents tampering
@@ -31,7 +32,6 @@ Compliance:
 - HIPAA-compliant encryption standards
 - OpenSSL cryptographic primitives
 - Industry-standard security practices
-- Tamper-evident audit log chains
 
 ==============================================================================
 """
@@ -39,31 +39,117 @@ Compliance:
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
-from cryptography.exceptions import InvalidKey
+from cryptography.exceptions import InvalidKey, InvalidTag
 import os
 import base64
+import msgpack
+import hashlib
+import hmac
+import functools
+import operator
 from datetime import datetime
 from dotenv import load_dotenv
 
+# Encrypted patient fields, in the order they are packed into the plaintext
+PATIENT_FIELDS = ('name', 'dob', 'address', 'phone', 'diagnosis', 'treatment', 'gender')
+
+# Fetching all PATIENT_FIELDS from a complete record in a single C-level call
+_get_patient_fields = operator.itemgetter(*PATIENT_FIELDS)
+
+# msgpack fixarray header for len(PATIENT_FIELDS) items; never the first byte of UTF-8 text
+_MSGPACK_HEADER = bytes([0x90 | len(PATIENT_FIELDS)])
+
+# Size of a wrapped per-record data key: IV (12) + AES-256 key (32) + GCM tag (16)
+WRAPPED_KEY_SIZE = 60
+
+# Associated data for wrapped data keys, so an older record encrypted directly
+# with the master key can never be mistaken for a wrapped key
+_WRAP_AAD = b'medical-records-dek'
+
+# Derived key and AESGCM instance per (salt, master key hash), so building
+# another MedicalCrypto in the same process skips PBKDF2
+_CACHED = {}
+
+@functools.lru_cache(maxsize=None)
+def _read_salt(salt_path):
+    # Reading the salt file once per process
+    try:
+        with open(salt_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        salt = os.urandom(16)
+        with open(salt_path, 'wb') as f:
+            f.write(salt)
+        return salt
+
+@functools.lru_cache(maxsize=None)
+def detect_crypto_acceleration():
+    # Reporting whether OpenSSL can use hardware AES and carry-less multiply for GCM
+    from cryptography.hazmat.backends.openssl.backend import backend
+
+    cpu_flags = set()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith(('flags', 'Features')):
+                    cpu_flags.update(line.split(':', 1)[1].split())
+                    break
+    except OSError:
+        pass
+
+    accel = {
+        'openssl_version': backend.openssl_version_text(),
+        'aes': 'aes' in cpu_flags,
+        # x86 exposes PCLMULQDQ, ARMv8 exposes PMULL for GHASH
+        'clmul': bool(cpu_flags & {'pclmulqdq', 'pmull'}),
+        # OPENSSL_ia32cap can mask CPU features from OpenSSL at runtime
+        'openssl_ia32cap': os.getenv('OPENSSL_ia32cap'),
+    }
+    accel['aes_gcm_accelerated'] = accel['aes'] and accel['clmul'] and not accel['openssl_ia32cap']
+
+    if not accel['aes_gcm_accelerated']:
+        print(f"Warning: AES-GCM hardware acceleration not detected ({accel['openssl_version']}); "
+              f"encryption will use the slower software path")
+    return accel
+
 class MedicalCrypto:   
-    def __init__(self):
+    def __init__(self, master_key=None):
+        # master_key overrides MEDICAL_MASTER_KEY, e.g. the previous key during rotation
         load_dotenv()
+        self._master_key = master_key
+        self.acceleration = detect_crypto_acceleration()
         self.salt = self._get_or_create_salt()
-        self.key = self._derive_key()
-        self.aesgcm = AESGCM(self.key)
+
+        master_key = self._get_master_key()
+        cache_key = (self.salt, hashlib.sha256(master_key).digest())
+        cached = _CACHED.get(cache_key)
+        if cached is None:
+            key = self._derive_key()
+            cached = _CACHED[cache_key] = (key, AESGCM(key))
+        self.key, self.aesgcm = cached
     
     def _get_or_create_salt(self):
         salt_path = os.path.join(os.path.dirname(__file__), 'salt.key')
+        return _read_salt(salt_path)
+
+    def _get_master_key(self):
+        if self._master_key is not None:
+            return self._master_key.encode()
+        return os.getenv('MEDICAL_MASTER_KEY', 'fallback-key-for-development').encode()
+
+    def _derive_key(self):
+        # Loading the previously derived key if it was derived from the same salt and master key
+        master_key = self._get_master_key()
+        dek_path = os.path.join(os.path.dirname(__file__), 'dek.bin')
+        gate = hashlib.sha256(self.salt + master_key).digest()
         try:
-            with open(salt_path, 'rb') as f:
-                return f.read()
+            with open(dek_path, 'rb') as f:
+                cached = f.read()
+            if len(cached) == 64 and hmac.compare_digest(cached[:32], gate):
+                return cached[32:]
         except FileNotFoundError:
-            salt = os.urandom(16)
-            with open(salt_path, 'wb') as f:
-                f.write(salt)
-            return salt
+            pass
 
-    def _derive_key(self):
         # Using PBKDF2 to derive a 32-byte key
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
@@ -71,72 +157,94 @@ class MedicalCrypto:
             salt=self.salt,
             iterations=100000,
         )
+        key = kdf.derive(master_key)
 
-        master_key = os.getenv('MEDICAL_MASTER_KEY', 'fallback-key-for-development').encode()
-        return kdf.derive(master_key)
+        # Caching the derived key (owner read/write only) to skip PBKDF2 on next startup;
+        # keys passed in explicitly are not cached so they don't evict the configured one
+        if self._master_key is not None:
+            return key
+        try:
+            fd = os.open(dek_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gate + key)
+        except OSError as e:
+            print(f"Could not cache derived key: {e}")
+        return key
 
     def encrypt_patient_data(self, patient_data):
         # Encrypting patient data using AES-256-GCM
         try:
-            # Converting dictionary to string
-            data_str = "|".join([
-                str(patient_data.get('name', '')),
-                str(patient_data.get('dob', '')),
-                str(patient_data.get('address', '')),
-                str(patient_data.get('phone', '')),
-                str(patient_data.get('diagnosis', '')),
-                str(patient_data.get('treatment', '')),
-                str(patient_data.get('gender', ''))
-            ])
+            # Packing fields as a msgpack array in PATIENT_FIELDS order
+            try:
+                values = _get_patient_fields(patient_data)
+            except KeyError:
+                values = [patient_data.get(k, '') for k in PATIENT_FIELDS]
+            plaintext = msgpack.packb(tuple(map(str, values)))
+
+            # Generating a per-record data key and wrapping it with the master key
+            dek = AESGCM.generate_key(bit_length=256)
+            wrapped_dek = self.wrap_key(dek)
 
             # Generating a random 96-bit IV
             iv = os.urandom(12)
             
-            # Encrypting the data
-            ciphertext = self.aesgcm.encrypt(
+            # Encrypting the data with the record's data key
+            ciphertext = AESGCM(dek).encrypt(
                 iv,
-                data_str.encode(),
+                plaintext,
                 None  
             )
             
-            # Combining IV and ciphertext
-            return base64.b64encode(iv + ciphertext)
+            # Combining wrapped key, IV and ciphertext, stored as raw bytes in the bytea column
+            return wrapped_dek + iv + ciphertext
         except Exception as e:
             print(f"Encryption error: {e}")
             return None
 
-    def decrypt_patient_data(self, encrypted_data):
-        # Decrypting patient data using AES-256-GCM
+    def wrap_key(self, dek):
+        # Encrypting a data key with the master key: IV (12) + key (32) + tag (16)
+        iv = os.urandom(12)
+        return iv + self.aesgcm.encrypt(iv, dek, _WRAP_AAD)
+
+    def unwrap_key(self, wrapped_dek):
+        return self.aesgcm.decrypt(wrapped_dek[:12], wrapped_dek[12:], _WRAP_AAD)
+
+    def _decrypt_raw(self, raw_data):
+        # Extracting IV and ciphertext, then decrypting
+        iv = raw_data[:12]
+        ciphertext = raw_data[12:]
+        return self.aesgcm.decrypt(iv, ciphertext, None)
+
+    def decrypt_patient_data(self, encrypted_data, strict=False):
+        # Decrypting patient data using AES-256-GCM; with strict=True failures are
+        # raised instead of returning empty fields
         try:
-            # Decoding from base64
-            raw_data = base64.b64decode(encrypted_data)
-        
-            # Extracting IV and ciphertext
-            iv = raw_data[:12]
-            ciphertext = raw_data[12:]
-        
-            # Decrypting the data
-            decrypted = self.aesgcm.decrypt(
-                iv,
-                ciphertext,
-                None
-            ).decode()
-        
-            # Splitting into fields
-            fields = decrypted.split('|')
-            if len(fields) < 7:  # Ensures we have all fields
-                fields.extend([''] * (7 - len(fields)))
+            raw_data = bytes(encrypted_data)
+
+            try:
+                dek = self.unwrap_key(raw_data[:WRAPPED_KEY_SIZE])
+                body = raw_data[WRAPPED_KEY_SIZE:]
+                decrypted = AESGCM(dek).decrypt(body[:12], body[12:], None)
+            except InvalidTag:
+                # Records written before per-record data keys are encrypted with the master key
+                try:
+                    decrypted = self._decrypt_raw(raw_data)
+                except InvalidTag:
+                    # Records written before raw storage are base64 encoded
+                    decrypted = self._decrypt_raw(base64.b64decode(raw_data))
+
+            if decrypted[:1] == _MSGPACK_HEADER:
+                fields = msgpack.unpackb(decrypted)
+            else:
+                # Records written before msgpack packing are "|"-joined text
+                fields = decrypted.decode().split('|')
+                if len(fields) < 7:  # Ensures we have all fields
+                    fields.extend([''] * (7 - len(fields)))
             
-            return {
-                'name': fields[0] or '',
-                'dob': fields[1] or '',
-                'address': fields[2] or '',
-                'phone': fields[3] or '',
-                'diagnosis': fields[4] or '',
-                'treatment': fields[5] or '',
-                'gender': fields[6] or ''
-            }
+            return {k: v or '' for k, v in zip(PATIENT_FIELDS, fields)}
         except Exception as e:
+            if strict:
+                raise
             print(f"Decryption error: {e}")
             return {
                 'name': '',
@@ -148,9 +256,27 @@ class MedicalCrypto:
                 'gender': ''
             }
         
-    def re_encrypt_data(self, encrypted_data):
+    def rewrap_key_only(self, encrypted_data, previous_crypto):
+        # Moving a record to the current master key by re-wrapping its data key;
+        # the payload ciphertext is left untouched
+        raw_data = bytes(encrypted_data)
+        dek = previous_crypto.unwrap_key(raw_data[:WRAPPED_KEY_SIZE])
+        return self.wrap_key(dek) + raw_data[WRAPPED_KEY_SIZE:]
+
+    def re_encrypt_data(self, encrypted_data, previous_crypto=None):
         # Re-encrypting data with current key
         try:
+            if previous_crypto is not None:
+                try:
+                    return self.rewrap_key_only(encrypted_data, previous_crypto)
+                except InvalidTag:
+                    # Older record layout without a data key; fall back to a full re-encryption
+                    decrypted_data = previous_crypto.decrypt_patient_data(encrypted_data)
+                    if not any(decrypted_data.values()):
+                        raise Exception("Decryption failed")
+                    return self.encrypt_patient_data(decrypted_data)
+
+
             # First trying to decrypt with current key
             decrypted_data = self.decrypt_patient_data(encrypted_data)
             
@@ -163,10 +289,3 @@ class MedicalCrypto:
         except Exception as e:
             print(f"Re-encryption error: {e}")
             return None
-    
-    def create_log_hash(self, prev_hash, role, action, details, timestamp):
-        # Creating hash for audit log entry using SHA-256
-        message = f"{prev_hash}{role}{action}{details}{timestamp}".encode()
-        hasher = hashes.Hash(hashes.SHA256())
-        hasher.update(message)
-        return hasher.finalize().hex()
\ No newline at end of file
@@ -1,14 +1,11 @@
 -- Create patients table
+-- Name, address, phone, diagnosis and treatment live only in encrypted_data;
+-- dob and gender stay in plaintext for the demographics aggregation
 CREATE TABLE IF NOT EXISTS patients (
     id SERIAL PRIMARY KEY,
-    name VARCHAR(100) NOT NULL,
     dob DATE NOT NULL,
     gender VARCHAR(10) NOT NULL,
-    address TEXT,
-    phone VARCHAR(20),
-    diagnosis TEXT NOT NULL,
-    treatment TEXT NOT NULL,
-    encrypted_data BYTEA
+    encrypted_data BYTEA NOT NULL
 );
 
 -- Create audit_logs table
@@ -20,4 +17,42 @@ CREATE TABLE IF NOT EXISTS audit_logs (
     timestamp TIMESTAMP NOT NULL,
     prev_hash VARCHAR(64) NOT NULL,
     hash VARCHAR(64) NOT NULL
-);
\ No newline at end of file
+);
+
+-- Hash chain head for audit_logs (single row, locked while appending)
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+
+CREATE TABLE IF NOT EXISTS audit_chain_head (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    hash VARCHAR(64) NOT NULL
+);
+
+INSERT INTO audit_chain_head (id, hash)
+SELECT TRUE, COALESCE((SELECT hash FROM audit_logs ORDER BY id DESC LIMIT 1), repeat('0', 64))
+ON CONFLICT (id) DO NOTHING;
+
+-- Append an audit log entry and return its hash in one round-trip
+CREATE OR REPLACE FUNCTION append_audit_log(
+    p_role VARCHAR,
+    p_action VARCHAR,
+    p_details TEXT,
+    p_timestamp TIMESTAMP
+) RETURNS VARCHAR AS $$
+DECLARE
+    v_prev_hash VARCHAR(64);
+    v_hash VARCHAR(64);
+BEGIN
+    SELECT hash INTO v_prev_hash FROM audit_chain_head WHERE id FOR UPDATE;
+
+    v_hash := encode(
+        digest(v_prev_hash || p_role || p_action || p_details || p_timestamp::text, 'sha256'),
+        'hex'
+    );
+
+    INSERT INTO audit_logs (role, action, details, timestamp, prev_hash, hash)
+    VALUES (p_role, p_action, p_details, p_timestamp, v_prev_hash, v_hash);
+
+    UPDATE audit_chain_head SET hash = v_hash WHERE id;
+    RETURN v_hash;
+END;
+$$ LANGUAGE plpgsql;
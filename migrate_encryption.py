@@ -27,6 +27,11 @@ Use Cases:
 - Upgrading encryption algorithms
 - Repairing corrupted encrypted data
 - Standardizing encryption across all records
+- Converting base64-encoded records to raw bytea storage
+- Upgrading an existing database schema from init.sql (--upgrade-schema)
+- Rotating the master key by re-wrapping per-record data keys (--rotate)
+- Re-encrypting large tables across several processes (--workers N)
+- Rebuilding encrypted_data from the plaintext columns, verifying it and dropping them (--drop-plaintext)
 
 Safety Features:
 - Non-destructive migration (preserves original data)
@@ -38,101 +43,228 @@ Safety Features:
 """
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from crypto_utils import MedicalCrypto
+from psycopg2.extras import RealDictCursor, execute_values
+from crypto_utils import MedicalCrypto, WRAPPED_KEY_SIZE
+from cryptography.exceptions import InvalidTag
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import os   
 from dotenv import load_dotenv
 
 def get_db_connection():
-    # Creating database connection using environment variables
+    # Creating database connection using the same DB_* environment variables as the app
     load_dotenv()
-    return psycopg2.connect(
-        host='localhost',
-        database='medical_records',
-        user='postgres',
-        password='admin123'
+    settings = {
+        'host': os.getenv('DB_HOST'),
+        'database': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+    }
+    if not all(settings.values()):
+        raise RuntimeError("Database environment variables are not set. Please configure .env before running.")
+    return psycopg2.connect(**settings)
+
+# Number of rows sent per batched UPDATE
+BATCH_SIZE = 500
+
+def flush_updates(cur, rows):
+    # Writing a batch of re-encrypted records in a single UPDATE ... FROM (VALUES ...)
+    if not rows:
+        return
+    execute_values(
+        cur,
+        'UPDATE patients SET encrypted_data = v.data FROM (VALUES %s) AS v(id, data) WHERE patients.id = v.id',
+        rows,
+        template='(%s, %s)',
+        page_size=BATCH_SIZE
     )
+    rows.clear()
+
+def flush_key_updates(cur, rows):
+    # Overwriting only the wrapped data key at the start of each record
+    if not rows:
+        return
+    execute_values(
+        cur,
+        'UPDATE patients SET encrypted_data = overlay(encrypted_data PLACING v.wrapped FROM 1 FOR %s) '
+        'FROM (VALUES %%s) AS v(id, wrapped) WHERE patients.id = v.id' % WRAPPED_KEY_SIZE,
+        rows,
+        template='(%s, %s)',
+        page_size=BATCH_SIZE
+    )
+    rows.clear()
+
+def rotate_master_key():
+    # Re-wrapping every record's data key from PREVIOUS_MEDICAL_MASTER_KEY to MEDICAL_MASTER_KEY
+    load_dotenv()
+    previous_master_key = os.getenv('PREVIOUS_MEDICAL_MASTER_KEY')
+    if not previous_master_key:
+        raise RuntimeError("PREVIOUS_MEDICAL_MASTER_KEY is not set. Set it to the master key being rotated out.")
 
-def migrate_encrypted_data():
-    # Migrating existing encrypted records to new encryption
     crypto = MedicalCrypto()
+    previous_crypto = MedicalCrypto(master_key=previous_master_key)
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    print("Starting master key rotation...")
+    cur.execute('SET LOCAL synchronous_commit = off')
+
+    # Only the wrapped data key of each record is read and rewritten
+    cur.execute(
+        'SELECT id, substring(encrypted_data FROM 1 FOR %s) AS wrapped_dek '
+        'FROM patients WHERE encrypted_data IS NOT NULL',
+        (WRAPPED_KEY_SIZE,)
+    )
+    patients = cur.fetchall()
+
+    total = len(patients)
+    rewrapped_count = 0
+    re_encrypted_count = 0
+    fail_count = 0
+    pending_keys = []
+    pending_updates = []
+
+    print(f"\nFound {total} records to process")
+
+    for patient in patients:
+        try:
+            new_wrapped_dek = crypto.rewrap_key_only(patient['wrapped_dek'], previous_crypto)
+            pending_keys.append((patient['id'], psycopg2.Binary(new_wrapped_dek)))
+            rewrapped_count += 1
+        except InvalidTag:
+            # Record written before per-record data keys; re-encrypting the full payload
+            cur.execute('SELECT encrypted_data FROM patients WHERE id = %s', (patient['id'],))
+            new_encrypted_data = crypto.re_encrypt_data(
+                cur.fetchone()['encrypted_data'], previous_crypto=previous_crypto
+            )
+            if new_encrypted_data:
+                pending_updates.append((patient['id'], psycopg2.Binary(new_encrypted_data)))
+                re_encrypted_count += 1
+            else:
+                fail_count += 1
+                print(f"Failed to re-encrypt patient ID: {patient['id']}")
+
+        if len(pending_keys) >= BATCH_SIZE:
+            flush_key_updates(cur, pending_keys)
+        if len(pending_updates) >= BATCH_SIZE:
+            flush_updates(cur, pending_updates)
+
+    flush_key_updates(cur, pending_keys)
+    flush_updates(cur, pending_updates)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    print(f"\n=== Key Rotation Summary ===")
+    print(f"Total records processed: {total}")
+    print(f"Data keys re-wrapped: {rewrapped_count}")
+    print(f"Records fully re-encrypted: {re_encrypted_count}")
+    print(f"Failed to process: {fail_count}")
+
+# MedicalCrypto for the current process (each worker process builds its own)
+_crypto = None
+
+def get_crypto():
+    global _crypto
+    if _crypto is None:
+        _crypto = MedicalCrypto()
+    return _crypto
+
+def plaintext_patient_data(patient):
+    # Patient data from the plaintext columns, in the form decrypt_patient_data returns
+    return {
+        'name': patient['name'] or '',
+        'dob': str(patient['dob']) if patient['dob'] else '',
+        'gender': patient['gender'] or '',
+        'address': patient['address'] or '',
+        'phone': patient['phone'] or '',
+        'diagnosis': patient['diagnosis'] or '',
+        'treatment': patient['treatment'] or ''
+    }
+
+def re_encrypt_record(patient):
+    # Re-encrypting one patient record; returns (new encrypted data or None, reconstructed, log lines)
+    crypto = get_crypto()
+    messages = [f"\nProcessing patient ID: {patient['id']}"]
+    try:
+        # While the plaintext columns exist they are the source of truth: older
+        # "|"-joined records decrypt with shifted fields when a value contains "|"
+        if 'name' in patient:
+            new_encrypted_data = crypto.encrypt_patient_data(plaintext_patient_data(patient))
+            
+            if new_encrypted_data:
+                messages.append(f"Successfully re-encrypted data from database fields")
+            else:
+                messages.append(f"Failed to encrypt database fields")
+            return new_encrypted_data, True, messages
+
+        # Plaintext columns already dropped; re-encrypting the decrypted record
+        decrypted_data = crypto.decrypt_patient_data(patient['encrypted_data'])
+        
+        # Checking if decryption failed (all fields empty)
+        if not any(decrypted_data.values()):
+            messages.append(f"Decryption failed and plaintext columns are dropped, cannot reconstruct")
+            return None, False, messages
+
+        new_encrypted_data = crypto.encrypt_patient_data(decrypted_data)
+        
+        if new_encrypted_data:
+            messages.append(f"Successfully re-encrypted existing data")
+        else:
+            messages.append(f"Failed to re-encrypt data")
+        return new_encrypted_data, False, messages
+            
+    except Exception as e:
+        messages.append(f"Error: {str(e)}")
+        return None, False, messages
+
+def re_encrypt_records(patients, workers=1):
+    # Records are independent (own data key and IV), so they can be re-encrypted in parallel
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(re_encrypt_record, patients, chunksize=BATCH_SIZE))
+    return [re_encrypt_record(patient) for patient in patients]
+
+def migrate_encrypted_data(workers=1):
+    # Migrating existing encrypted records to new encryption
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     print("Starting encryption migration...")
     
+    # The whole migration runs as one transaction; skip waiting on WAL flush per commit
+    cur.execute('SET LOCAL synchronous_commit = off')
+
     # Getting all patients with encrypted data
     cur.execute('SELECT * FROM patients WHERE encrypted_data IS NOT NULL')
-    patients = cur.fetchall()
+    # Converting memoryview to bytes so records can be sent to worker processes
+    patients = [dict(p, encrypted_data=bytes(p['encrypted_data'])) for p in cur.fetchall()]
     
     total = len(patients)
     success_count = 0
     fail_count = 0
     reconstructed_count = 0
+    pending_updates = []
     
     print(f"\nFound {total} records to process")
-    
-    for patient in patients:
-        try:
-            print(f"\nProcessing patient ID: {patient['id']} ({patient['name']})")
-            
-            # Converting memoryview to bytes if needed
-            if isinstance(patient['encrypted_data'], memoryview):
-                encrypted_bytes = patient['encrypted_data'].tobytes()
-            else:
-                encrypted_bytes = bytes(patient['encrypted_data'])
-                
-            # Trying to decrypt first
-            decrypted_data = crypto.decrypt_patient_data(encrypted_bytes)
-            
-            # Checking if decryption failed (all fields empty)
-            if not any(decrypted_data.values()):
-                print(f"Decryption failed, reconstructing from database fields...")
-                
-                # Reconstructing patient data from database fields
-                patient_data = {
-                    'name': patient['name'] or '',
-                    'dob': str(patient['dob']) if patient['dob'] else '',
-                    'gender': patient['gender'] or '',
-                    'address': patient['address'] or '',
-                    'phone': patient['phone'] or '',
-                    'diagnosis': patient['diagnosis'] or '',
-                    'treatment': patient['treatment'] or ''
-                }
-                
-                # Encrypting with current key
-                new_encrypted_data = crypto.encrypt_patient_data(patient_data)
-                
-                if new_encrypted_data:
-                    cur.execute(
-                        'UPDATE patients SET encrypted_data = %s WHERE id = %s',
-                        (new_encrypted_data, patient['id'])
-                    )
-                    reconstructed_count += 1
-                    success_count += 1
-                    print(f"Successfully reconstructed and re-encrypted data")
-                else:
-                    fail_count += 1
-                    print(f"Failed to encrypt reconstructed data")
-            else:
-                # Decryption worked, just re-encrypting with current key
-                new_encrypted_data = crypto.encrypt_patient_data(decrypted_data)
-                
-                if new_encrypted_data:
-                    cur.execute(
-                        'UPDATE patients SET encrypted_data = %s WHERE id = %s',
-                        (new_encrypted_data, patient['id'])
-                    )
-                    success_count += 1
-                    print(f"Successfully re-encrypted existing data")
-                else:
-                    fail_count += 1
-                    print(f"Failed to re-encrypt data")
-                
-        except Exception as e:
+
+    results = re_encrypt_records(patients, workers)
+
+    for patient, (new_encrypted_data, reconstructed, messages) in zip(patients, results):
+        print("\n".join(messages))
+
+        if new_encrypted_data:
+            pending_updates.append((patient['id'], psycopg2.Binary(new_encrypted_data)))
+            success_count += 1
+            if reconstructed:
+                reconstructed_count += 1
+        else:
             fail_count += 1
-            print(f"Error: {str(e)}")
+
+        if len(pending_updates) >= BATCH_SIZE:
+            flush_updates(cur, pending_updates)
     
+    flush_updates(cur, pending_updates)
     conn.commit()
     cur.close()
     conn.close()
@@ -142,6 +274,107 @@ def migrate_encrypted_data():
     print(f"Successfully re-encrypted: {success_count}")
     print(f"Records reconstructed from DB: {reconstructed_count}")
     print(f"Failed to process: {fail_count}")
+    return fail_count
+
+def upgrade_schema():
+    # Applying init.sql to an existing database; every statement in it is idempotent,
+    # so this adds audit_chain_head and append_audit_log() without touching existing data
+    init_sql_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'init.sql')
+    with open(init_sql_path) as f:
+        init_sql = f.read()
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    print("Applying init.sql...")
+    cur.execute(init_sql)
+    conn.commit()
+    cur.close()
+    conn.close()
+    print("Schema is up to date")
+
+# Columns whose values are only kept inside encrypted_data
+PLAINTEXT_COLUMNS = ('name', 'address', 'phone', 'diagnosis', 'treatment')
+
+def drop_plaintext_columns(workers=1):
+    # Rebuilding encrypted_data from the plaintext columns, checking every stored record
+    # decrypts back to those columns, and only then dropping them
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = 'patients' AND column_name = ANY(%s)",
+        (list(PLAINTEXT_COLUMNS),)
+    )
+    existing = [row['column_name'] for row in cur.fetchall()]
+    if len(existing) < len(PLAINTEXT_COLUMNS):
+        print("Plaintext columns already dropped" if not existing else
+              f"Only some plaintext columns remain ({', '.join(existing)}); not touching them")
+        conn.close()
+        return
+
+    # Blocking writes until the columns are dropped so nothing changes after verification
+    cur.execute('LOCK TABLE patients IN EXCLUSIVE MODE')
+    cur.execute('SET LOCAL synchronous_commit = off')
+
+    print("Rebuilding encrypted data from plaintext columns...")
+    cur.execute('SELECT * FROM patients')
+    patients = [dict(p, encrypted_data=None) for p in cur.fetchall()]
+    expected = {p['id']: plaintext_patient_data(p) for p in patients}
+
+    pending_updates = []
+    for patient, (new_encrypted_data, _, messages) in zip(patients, re_encrypt_records(patients, workers)):
+        if not new_encrypted_data:
+            print("\n".join(messages))
+            print("\nA record could not be encrypted; plaintext columns were kept")
+            conn.rollback()
+            conn.close()
+            return
+        pending_updates.append((patient['id'], psycopg2.Binary(new_encrypted_data)))
+        if len(pending_updates) >= BATCH_SIZE:
+            flush_updates(cur, pending_updates)
+    flush_updates(cur, pending_updates)
+
+    print("Verifying stored records...")
+    crypto = get_crypto()
+    cur.execute('SELECT id, encrypted_data FROM patients')
+    mismatched = [
+        row['id'] for row in cur.fetchall()
+        if row['encrypted_data'] is None
+        or crypto.decrypt_patient_data(row['encrypted_data']) != expected.get(row['id'])
+    ]
+    if mismatched:
+        print(f"Records not matching their plaintext columns: {mismatched}; plaintext columns were kept")
+        conn.rollback()
+        conn.close()
+        return
+
+    print(f"Dropping columns: {', '.join(existing)}")
+    cur.execute(
+        'ALTER TABLE patients ' + ', '.join(f'DROP COLUMN {column}' for column in existing) +
+        ', ALTER COLUMN encrypted_data SET NOT NULL'
+    )
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"Dropped plaintext columns for {len(patients)} records")
 
 if __name__ == "__main__":
-    migrate_encrypted_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Re-encrypt patient records")
+    parser.add_argument('--upgrade-schema', action='store_true',
+                        help="apply init.sql (audit hash chain function and tables) to an existing database")
+    parser.add_argument('--rotate', action='store_true',
+                        help="re-wrap data keys from PREVIOUS_MEDICAL_MASTER_KEY to MEDICAL_MASTER_KEY")
+    parser.add_argument('--drop-plaintext', action='store_true',
+                        help="rebuild encrypted_data from the plaintext patient columns, verify it and drop them")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes used to re-encrypt records in parallel (default: 1)")
+    args = parser.parse_args()
+
+    if args.upgrade_schema:
+        upgrade_schema()
+    elif args.drop_plaintext:
+        drop_plaintext_columns(workers=args.workers)
+    elif args.rotate:
+        rotate_master_key()
+    else:
+        migrate_encrypted_data(workers=args.workers)